@@ -0,0 +1,40 @@
+# cython: language_level=3
+#
+# C parsers for the procfs buffers read by ampm.py on every tick.
+# Build in place with: cythonize -i _ampm_tick.pyx
+
+from libc.stdlib cimport strtoll
+from libc.string cimport strchr, strrchr, strstr
+
+
+def stat_fields(bytes buf):
+    cdef const char *p = buf
+    cdef char *end
+    cdef long long f[7]
+    cdef int i
+
+    # comm may contain spaces or ')', so start after the last ')'
+    p = strrchr(p, c')')
+    if p == NULL:
+        raise ValueError('malformed stat')
+    # skip state .. cmajflt to reach utime
+    p = p + 2
+    for i in range(11):
+        p = strchr(p, c' ')
+        if p == NULL:
+            raise ValueError('malformed stat')
+        p = p + 1
+    # utime, stime, cutime, cstime, priority, nice, num_threads
+    for i in range(7):
+        f[i] = strtoll(p, &end, 10)
+        if end == p:
+            raise ValueError('malformed stat')
+        p = end
+    return f[0], f[1], f[2], f[3], f[6]
+
+
+def vmrss(bytes buf):
+    cdef const char *p = strstr(buf, b'\nVmRSS:')
+    if p == NULL:
+        return -1
+    return strtoll(p + 7, NULL, 10)
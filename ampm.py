@@ -1,119 +1,367 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import ctypes
+import ctypes.util
+import itertools
 import os
-import subprocess
+import queue
+import select
 import sys
 import threading
 import time
 
+try:
+    import _ampm_tick
+except ImportError:
+    _ampm_tick = None
 
-class CPUTime:
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-    CLK_TCK = float(subprocess.run(
-        ['getconf', 'CLK_TCK'], capture_output=True).stdout)
 
-    def __init__(self, utime: int, stime: int, cutime: int, cstime: int,
-                 num_threads: int):
-        self._utime = utime
-        self._stime = stime
-        self._cutime = cutime
-        self._cstime = cstime
-        self._cpu_max = num_threads * 100.0
-
-    def usage(self, interval: float, diff_usage) -> float:
-        diff = (diff_usage._utime - self._utime) + \
-            (diff_usage._stime - self._stime) + \
-            (diff_usage._cutime - self._cutime) + \
-            (diff_usage._cstime - self._cstime)
-        usage = (diff/(interval * CPUTime.CLK_TCK))*100.0
-        if usage > (diff_usage._cpu_max):
-            return diff_usage._cpu_max
-        return usage
+CLK_TCK = float(os.sysconf('SC_CLK_TCK'))
 
 
 class UsageHistory:
 
-    def __init__(self):
-        self._rss = []
-        self._cpu = []
+    # samples preallocated at most, append() grows the arrays past it
+    MAX_PREALLOC = 1 << 16
+
+    def __init__(self, capacity: int = 0):
+        # 8 bytes per sample, preallocated when the number is known
+        n = min(capacity, UsageHistory.MAX_PREALLOC)
+        self._cpu = array.array('d', [0.0]) * n
+        self._rss = array.array('q', [0]) * n
         self._index = -1
-        self._read = -1
-        self._cv = threading.Condition()
-        self._term = False
+        # samples are handed to the printer without taking a lock
+        self._q = queue.SimpleQueue()
 
     def append(self, cpu: float, rss: int):
-        with self._cv:
+        self._index = self._index + 1
+        if self._index < len(self._cpu):
+            self._cpu[self._index] = cpu
+            self._rss[self._index] = rss
+        else:
             self._cpu.append(cpu)
             self._rss.append(rss)
-            self._index = self._index + 1
-            self._cv.notify()
-
-    def get(self) -> (float, int, bool):
-        with self._cv:
-            while self._index == self._read and not self._term:
-                self._cv.wait()
-            if self._index != self._read:
-                self._read = self._read + 1
-                return self._cpu[self._index], self._rss[self._index], True
-        return 0.0, 0, False
+        self._q.put((cpu, rss))
 
-    def term(self):
-        with self._cv:
-            self._term = True
-            self._cv.notify()
+    def get(self, timeout: float = None) -> (float, int, bool):
+        # raises queue.Empty on timeout
+        sample = self._q.get(timeout=timeout)
+        if sample is None:
+            return 0.0, 0, False
+        return sample[0], sample[1], True
 
-    def is_term(self):
-        with self._cv:
-            return self._term
+    def term(self):
+        # wake up the printer after the remaining samples
+        self._q.put(None)
 
     def empty(self) -> bool:
-        with self._cv:
-            return (len(self._cpu) == 0 or len(self._rss) == 0)
+        return self._index < 0
+
+    def _views(self) -> tuple:
+        n = self._index + 1
+        if numpy is None:
+            return self._cpu[:n], self._rss[:n]
+        # zero-copy, the reductions run in C over the raw samples
+        return numpy.frombuffer(self._cpu, dtype=numpy.float64, count=n), \
+            numpy.frombuffer(self._rss, dtype=numpy.int64, count=n)
 
     def max(self) -> (float, int):
-        with self._cv:
-            return max(self._cpu), max(self._rss)
+        cpu, rss = self._views()
+        if numpy is None:
+            return max(cpu), max(rss)
+        return float(cpu.max()), int(rss.max())
 
     def min(self) -> (float, int):
-        with self._cv:
-            return min(self._cpu), min(self._rss)
+        cpu, rss = self._views()
+        if numpy is None:
+            return min(cpu), min(rss)
+        return float(cpu.min()), int(rss.min())
 
     def ave(self) -> (float, int):
-        with self._cv:
-            return sum(self._cpu)/len(self._cpu), \
-                sum(self._rss)//len(self._rss)
+        cpu, rss = self._views()
+        if numpy is None:
+            return sum(cpu)/len(cpu), sum(rss)//len(rss)
+        return float(cpu.mean()), int(rss.sum())//len(rss)
 
 
-def read_stat(pid: int) -> CPUTime:
-    with open(os.path.join('/proc', str(pid), 'stat'), 'r') as f:
-        s = f.read().split()
-    # utime, stime, cutime, cstime, num_threads
-    return CPUTime(int(s[13]), int(s[14]), int(s[15]), int(s[16]), int(s[19]))
+class ProcReader:
 
+    BUF_SIZE = 4096
 
-def read_comm(pid: int) -> str:
-    parent = os.path.join('/proc', str(pid))
-    comm = ''
-    with open(os.path.join(parent, 'cmdline'), 'r') as f:
-        cmdline = f.read().split('\0')[0]
-    if len(cmdline) > 0:
-        comm = cmdline
-    else:
-        with open(os.path.join(parent, 'comm'), 'r') as f:
-            comm = f.read()
-    return comm.split()[0]
+    def __init__(self, fds: list):
+        self._fds = fds
 
+    def read(self) -> list:
+        # procfs files are regenerated on every read from offset 0
+        return [os.pread(fd, ProcReader.BUF_SIZE, 0) for fd in self._fds]
 
-def read_smaps(pid: int) -> int:
+    def close(self):
+        pass
+
+
+class IoUringCqe(ctypes.Structure):
+    _fields_ = [('user_data', ctypes.c_uint64),
+                ('res', ctypes.c_int32),
+                ('flags', ctypes.c_uint32)]
+
+
+class URingReader(ProcReader):
+
+    IOSQE_FIXED_FILE = 1 << 0
+    # larger than struct io_uring of any liburing release
+    RING_SIZE = 512
+
+    def __init__(self, fds: list, lib: ctypes.CDLL):
+        super().__init__(fds)
+        lib.io_uring_get_sqe.restype = ctypes.c_void_p
+        lib.io_uring_prep_read.argtypes = [
+            ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+            ctypes.c_uint64]
+        lib.io_uring_sqe_set_flags.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+        lib.io_uring_sqe_set_data64.argtypes = [ctypes.c_void_p,
+                                                ctypes.c_uint64]
+        self._lib = lib
+        self._ring = (ctypes.c_uint64 * (URingReader.RING_SIZE // 8))()
+        ret = lib.io_uring_queue_init(len(fds), self._ring, 0)
+        if ret < 0:
+            raise OSError(-ret, os.strerror(-ret))
+        files = (ctypes.c_int * len(fds))(*fds)
+        ret = lib.io_uring_register_files(self._ring, files, len(fds))
+        if ret < 0:
+            lib.io_uring_queue_exit(self._ring)
+            raise OSError(-ret, os.strerror(-ret))
+        self._bufs = [ctypes.create_string_buffer(ProcReader.BUF_SIZE)
+                      for _ in fds]
+        self._cqes = (ctypes.POINTER(IoUringCqe) * len(fds))()
+
+    def read(self) -> list:
+        lib = self._lib
+        nr = len(self._fds)
+        for i in range(nr):
+            sqe = lib.io_uring_get_sqe(self._ring)
+            # i is the index of the registered file
+            lib.io_uring_prep_read(sqe, i, self._bufs[i],
+                                   ProcReader.BUF_SIZE, 0)
+            lib.io_uring_sqe_set_flags(sqe, URingReader.IOSQE_FIXED_FILE)
+            lib.io_uring_sqe_set_data64(sqe, i)
+        ret = lib.io_uring_submit_and_wait(self._ring, nr)
+        if ret < 0:
+            raise OSError(-ret, os.strerror(-ret))
+
+        bufs = [b''] * nr
+        done = 0
+        err = 0
+        while done < nr:
+            n = lib.io_uring_peek_batch_cqe(self._ring, self._cqes, nr - done)
+            for cqe in self._cqes[:n]:
+                i = cqe.contents.user_data
+                res = cqe.contents.res
+                if res < 0:
+                    err = -res
+                else:
+                    bufs[i] = self._bufs[i].raw[:res]
+            lib.io_uring_cq_advance(self._ring, n)
+            done = done + n
+        if err != 0:
+            raise OSError(err, os.strerror(err))
+        return bufs
+
+    def close(self):
+        self._lib.io_uring_queue_exit(self._ring)
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+
+class Deadline:
+
+    CLOCK_MONOTONIC = 1
+    TIMER_ABSTIME = 1
+    EINTR = 4
+
+    # the epoll wait is cut short by this much and clock_nanosleep
+    # sleeps the rest, since epoll only has ms resolution
+    EPOLL_SLACK = 1000000
+
+    # when the average tick cost exceeds SLOW_DOWN of the interval, the
+    # interval is doubled; it is halved again below SPEED_UP
+    EWMA_WEIGHT = 0.125
+    SLOW_DOWN = 0.5
+    SPEED_UP = 0.125
+
+    def __init__(self, interval: float, pidfd: int = -1):
+        self._interval = int(interval * 1e9)
+        # number of nominal intervals per tick
+        self.factor = 1
+        self._cost = 0.0
+        self._ep = None
+        if pidfd >= 0:
+            # a pidfd becomes readable when the process exits
+            self._ep = select.epoll()
+            self._ep.register(pidfd, select.EPOLLIN)
+        # absolute CLOCK_MONOTONIC time of the next tick [ns]
+        self._next = time.monotonic_ns() + self._interval
+        self._ts = Timespec()
+        name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(name) if name is not None else None
+        self._clock_nanosleep = getattr(libc, 'clock_nanosleep', None)
+
+    def wait(self) -> bool:
+        # returns False if the process has exited
+        if self._ep is not None:
+            timeout = self._next - time.monotonic_ns() - Deadline.EPOLL_SLACK
+            if len(self._ep.poll(max(timeout, 0) / 1e9)) > 0:
+                return False
+        if self._clock_nanosleep is None:
+            sleep_time = (self._next - time.monotonic_ns()) / 1e9
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            return True
+        self._ts.tv_sec, self._ts.tv_nsec = divmod(self._next, 1000000000)
+        while self._clock_nanosleep(
+                Deadline.CLOCK_MONOTONIC, Deadline.TIMER_ABSTIME,
+                ctypes.byref(self._ts), None) == Deadline.EINTR:
+            pass
+        return True
+
+    def advance(self, now: int):
+        # stay on the original phase, skipping the ticks already missed
+        interval = self._interval * self.factor
+        self._next = self._next + interval
+        while self._next <= now:
+            self._next = self._next + interval
+
+    def adapt(self, cost: int):
+        self._cost = self._cost + (cost - self._cost) * Deadline.EWMA_WEIGHT
+        interval = self._interval * self.factor
+        if self._cost > interval * Deadline.SLOW_DOWN:
+            self.factor = self.factor * 2
+        elif self.factor > 1 and self._cost < interval * Deadline.SPEED_UP:
+            self.factor = self.factor // 2
+        else:
+            return
+        print(f'Sampling every {self._interval * self.factor / 1e6:.1f} ms,'
+              f' a tick takes {self._cost / 1e6:.1f} ms', file=sys.stderr)
+
+    def close(self):
+        if self._ep is not None:
+            self._ep.close()
+
+
+def open_pidfd(pid: int) -> int:
+    # Python >= 3.9 and Linux >= 5.3
     try:
-        with open(os.path.join('/proc', str(pid), 'smaps_rollup'), 'r') as f:
-            next(f)
-            rss = int(f.readline().split()[1])
-    except OSError:
-        rss = 0
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return -1
+
+
+def open_reader(fds: list) -> ProcReader:
+    # batch the reads into one io_uring_enter() if liburing is available
+    name = ctypes.util.find_library('uring-ffi')
+    if name is None:
+        return ProcReader(fds)
+    try:
+        return URingReader(fds, ctypes.CDLL(name))
+    except (OSError, AttributeError):
+        return ProcReader(fds)
+
+
+def stat_fields(buf: bytes) -> tuple:
+    # comm may contain spaces or ')', so start after the last ')'
+    i = buf.rindex(b')') + 2
+    # skip state .. cmajflt to reach utime
+    for _ in range(11):
+        i = buf.index(b' ', i) + 1
+    j = buf.index(b' ', i)
+    utime = int(buf[i:j])
+    i = buf.index(b' ', j + 1)
+    stime = int(buf[j:i])
+    j = buf.index(b' ', i + 1)
+    cutime = int(buf[i:j])
+    i = buf.index(b' ', j + 1)
+    cstime = int(buf[j:i])
+    # skip priority and nice
+    i = buf.index(b' ', buf.index(b' ', i + 1) + 1)
+    num_threads = int(buf[i:buf.index(b' ', i + 1)])
+    return utime, stime, cutime, cstime, num_threads
+
+
+def vmrss(buf: bytes) -> int:
+    i = buf.find(b'\nVmRSS:')
+    if i < 0:
+        return -1
+    i = i + len(b'\nVmRSS:')
+    return int(buf[i:buf.index(b' kB', i)])
+
+
+if _ampm_tick is not None:
+    stat_fields = _ampm_tick.stat_fields  # noqa: F811
+    vmrss = _ampm_tick.vmrss  # noqa: F811
+
+
+def read_file(path: str) -> bytes:
+    # procfs files are read raw, without a TextIOWrapper
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.read(fd, ProcReader.BUF_SIZE)
+    finally:
+        os.close(fd)
+
+
+def read_comm(parent: str) -> str:
+    comm = read_file(os.path.join(parent, 'cmdline')).split(b'\0')[0]
+    if len(comm) == 0:
+        comm = read_file(os.path.join(parent, 'comm'))
+    return os.fsdecode(comm.split()[0])
 
-    return rss
+
+def read_smaps(smaps_path: str) -> int:
+    try:
+        buf = read_file(smaps_path)
+    except OSError:
+        return 0
+    i = buf.find(b'\nRss:')
+    if i < 0:
+        return 0
+    i = i + len(b'\nRss:')
+    return int(buf[i:buf.index(b' kB', i)])
+
+
+TICK_SRC = '''
+def tick(stat_buf, status_buf, elapsed, p_utime, p_stime, p_cutime, p_cstime,
+         stat_fields=stat_fields, vmrss=vmrss, read_smaps=read_smaps):
+    utime, stime, cutime, cstime, num_threads = stat_fields(stat_buf)
+    diff = (utime - p_utime) + (stime - p_stime) + \\
+        (cutime - p_cutime) + (cstime - p_cstime)
+    cpu = diff * {usage_scale!r} / elapsed
+    # status is much cheaper than smaps_rollup, which walks all the PTEs
+    rss = vmrss(status_buf)
+    if rss < 0:
+        rss = read_smaps({smaps_path!r})
+    return cpu, rss, utime, stime, cutime, cstime, num_threads
+'''
+
+
+def make_tick(smaps_path: str):
+    # the per-run constants are baked into the code as literals and the
+    # helpers are bound as defaults, so the tick does no global lookups
+    # %CPU = ticks / (elapsed [ns] * CLK_TCK / 1e9) * 100
+    src = TICK_SRC.format(usage_scale=1e11 / CLK_TCK,
+                          smaps_path=smaps_path)
+    ns = {'stat_fields': stat_fields, 'vmrss': vmrss,
+          'read_smaps': read_smaps}
+    exec(compile(src, '<ampm tick>', 'exec'), ns)
+    return ns['tick']
 
 
 def print_summary(hist: UsageHistory):
@@ -127,54 +375,148 @@ def print_summary(hist: UsageHistory):
     print(f'Ave:  {aves[0]:5.1f}  {aves[1]:,}')
 
 
+FLUSH_LINES = 100
+FLUSH_INTERVAL = 0.1
+
+
+def write_out(buf: bytearray):
+    view = memoryview(buf)
+    while len(view) > 0:
+        view = view[os.write(sys.stdout.fileno(), view):]
+    view.release()
+    buf.clear()
+
+
 def print_lines(comm: str, sep: str, hist: UsageHistory):
+    # lines are accumulated and written in batches, so a slow terminal
+    # does not hold up the sampler
+    sys.stdout.flush()
     # header
-    print(f'Command{sep}%CPU{sep}kB_RSS')
-    while not hist.is_term():
-        cpu, rss, ret = hist.get()
-        if ret:
-            print(f'{comm}{sep}{cpu:.1f}{sep}{rss}')
+    buf = bytearray(f'Command{sep}%CPU{sep}kB_RSS\n'.encode())
+    fmt = os.fsencode(comm).replace(b'%', b'%%') + \
+        f'{sep}%.1f{sep}%d\n'.encode()
+    lines = 0
+    flush_t = time.monotonic() + FLUSH_INTERVAL
+    while True:
+        timeout = None
+        if len(buf) > 0:
+            timeout = max(flush_t - time.monotonic(), 0.0)
+        try:
+            cpu, rss, ret = hist.get(timeout)
+        except queue.Empty:
+            write_out(buf)
+            lines = 0
+            continue
+        if not ret:
+            break
+        if len(buf) == 0:
+            flush_t = time.monotonic() + FLUSH_INTERVAL
+        buf += fmt % (cpu, rss)
+        lines = lines + 1
+        if lines == FLUSH_LINES:
+            write_out(buf)
+            lines = 0
+    write_out(buf)
+
+
+def tune_sampler(cpu: int):
+    # these only affect the calling thread on Linux
+    os.sched_setaffinity(0, {cpu})
+    try:
+        os.nice(-5)
+    except PermissionError:
+        pass
+    if os.geteuid() == 0:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(1))
+        except PermissionError:
+            pass
 
 
-def run(pid: int, rate: float, duration: float, output_type: str):
+def run(pid: int, rate: float, duration: float, output_type: str,
+        pin: int = None):
     if output_type == 'csv':
         sep = ','
     else:
         sep = ' '
     if duration == 0:
-        times = sys.maxsize
+        times = None
     else:
         times = int(duration * rate)
 
     interval = 1/rate
-    t = time.perf_counter()
-    b_cpu = read_stat(pid)
-    comm = read_comm(pid)
-    prev_cpu = b_cpu
+    # keep the fds open, procfs files can be re-read from offset 0
+    proc_dir = os.path.join('/proc', str(pid))
+    stat_fd = os.open(os.path.join(proc_dir, 'stat'), os.O_RDONLY)
+    try:
+        status_fd = os.open(os.path.join(proc_dir, 'status'), os.O_RDONLY)
+    except OSError:
+        os.close(stat_fd)
+        raise
 
-    hist = UsageHistory()
+    pidfd = open_pidfd(pid)
+
+    try:
+        reader = open_reader([stat_fd, status_fd])
+        try:
+            sample(proc_dir, reader, pidfd, interval, times, sep, pin)
+        finally:
+            reader.close()
+    finally:
+        if pidfd >= 0:
+            os.close(pidfd)
+        os.close(status_fd)
+        os.close(stat_fd)
+
+
+def sample(proc_dir: str, reader: ProcReader, pidfd: int, interval: float,
+           times: int, sep: str, pin: int):
+    deadline = Deadline(interval, pidfd)
+    t = time.monotonic_ns()
+    # the previous tick counts are kept as plain ints across samples
+    p_utime, p_stime, p_cutime, p_cstime, _ = stat_fields(reader.read()[0])
+    comm = read_comm(proc_dir)
+    tick = make_tick(os.path.join(proc_dir, 'smaps_rollup'))
+
+    hist = UsageHistory(times if times is not None else 0)
 
     print_t = threading.Thread(target=print_lines, args=(comm, sep, hist))
     print_t.start()
 
     try:
-        while times > 0:
-            sleep_time = interval - (time.perf_counter() - t)
-            if sleep_time > 0:
-                time.sleep(sleep_time)
-
-            t = time.perf_counter()
-            diff_cpu = read_stat(pid)
-            cpu_usage = prev_cpu.usage(interval, diff_cpu)
-            prev_cpu = diff_cpu
-
-            rss = read_smaps(pid)
+        if pin is not None:
+            tune_sampler(pin)
+
+        ticks = iter(range(times)) if times is not None else itertools.count()
+        for _ in ticks:
+            if not deadline.wait():
+                break
+
+            now = time.monotonic_ns()
+            try:
+                stat_buf, status_buf = reader.read()
+            except ProcessLookupError:
+                # exited and reaped after the pidfd was polled
+                break
+            # use the measured interval, the wakeup may be late
+            cpu_usage, rss, p_utime, p_stime, p_cutime, p_cstime, \
+                num_threads = tick(stat_buf, status_buf, now - t,
+                                   p_utime, p_stime, p_cutime, p_cstime)
+            if cpu_usage > num_threads * 100.0:
+                cpu_usage = num_threads * 100.0
+            t = now
+            # slow down when the ticks cannot keep up with the rate
+            deadline.adapt(time.monotonic_ns() - now)
+            deadline.advance(now)
 
             hist.append(cpu_usage, rss)
-            times = times - 1
+            # a slowed down tick stands for several nominal ones
+            for _ in itertools.islice(ticks, deadline.factor - 1):
+                pass
     except KeyboardInterrupt:
         pass
     finally:
+        deadline.close()
         hist.term()
         print_t.join()
         if not hist.empty():
@@ -198,12 +540,20 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--type',
                         help='Output type. default:"" [|csv]',
                         default='', action='store')
+    parser.add_argument('-p', '--pin',
+                        help='pin the sampler to this CPU and raise its\
+                        priority where permitted. default: not pinned',
+                        type=int, default=None, action='store')
 
     args = parser.parse_args()
 
-    if args.rate > float(CPUTime.CLK_TCK)/2.0:
-        print(f'Your rate exceeds the limit [{int(CPUTime.CLK_TCK)/2}]!',
+    if args.rate > CLK_TCK/2.0:
+        print(f'Your rate exceeds the limit [{int(CLK_TCK)/2}]!',
               file=sys.stderr)
         sys.exit(1)
 
-    run(args.pid, args.rate, float(args.duration), args.type)
+    if args.pin is not None and args.pin not in os.sched_getaffinity(0):
+        print(f'CPU {args.pin} is not available!', file=sys.stderr)
+        sys.exit(1)
+
+    run(args.pid, args.rate, float(args.duration), args.type, args.pin)